@@ -0,0 +1,364 @@
+import os
+import json
+import heapq
+import threading
+import logging
+import xml.etree.ElementTree as ET
+
+from folder_cache import ANNOTATION_EXTENSIONS, cache_path, load_cache, save_cache, stat_matches, scan_folder
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'annotation_index.json'
+INDEX_VERSION = 3
+
+# Object children holding polygon vertices, as "x1,y1 x2,y2 ..." text or a points attribute
+XML_POLYGON_TAGS = ('polygon', 'segmentation')
+# Object children that are structure, not attributes
+XML_STRUCTURE_TAGS = {'name', 'bndbox', 'polygon', 'segmentation'}
+# LabelMe shape keys that are structure, not attributes
+JSON_STRUCTURE_KEYS = {'label', 'points', 'shape_type', 'group_id', 'flags', 'description', 'mask'}
+
+LEVEL_OBJECTS = 'objects'
+LEVEL_FILES = 'files'
+
+
+class QueryError(ValueError):
+    """Raised for malformed queries"""
+
+
+def _to_float(text, default=0.0):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_points(text):
+    numbers = [_to_float(part, None) for part in text.replace(',', ' ').split()]
+    if None in numbers:
+        return []
+    return numbers if len(numbers) >= 6 and len(numbers) % 2 == 0 else []
+
+
+def read_annotation_file(file_path):
+    """Parse an XML or LabelMe JSON file into (image_filename, width, height, objects)
+
+    Each object is (class_name, bbox, [x1, y1, x2, y2, ...], {attribute: value}), where bbox is
+    (xmin, ymin, xmax, ymax) or None when the object has no <bndbox>. This is the one parser
+    behind the query index and the dataset snapshot.
+    """
+    objects = []
+    if os.path.getsize(file_path) == 0:
+        return '', 0, 0, objects
+
+    if str(file_path).lower().endswith('.json'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for shape in data.get('shapes', []):
+            vertices = [_to_float(value) for point in shape.get('points', []) for value in point[:2]]
+            attributes = {key: str(value).strip() for key, value in shape.items()
+                          if key not in JSON_STRUCTURE_KEYS and not isinstance(value, (dict, list))}
+            objects.append((str(shape.get('label', 'unknown')).strip(), None, vertices, attributes))
+        width, height = _to_float(data.get('imageWidth')), _to_float(data.get('imageHeight'))
+        return str(data.get('imagePath') or ''), int(width), int(height), objects
+
+    root = ET.parse(file_path).getroot()
+    size = root.find('size')
+    width = _to_float(size.findtext('width')) if size is not None else 0
+    height = _to_float(size.findtext('height')) if size is not None else 0
+    for obj in root.findall('object'):
+        name = obj.find('name')
+        # An empty <name/> gives '' (only a missing <name> is 'unknown')
+        class_name = (name.text or '').strip() if name is not None else 'unknown'
+        bbox = None
+        bndbox = obj.find('bndbox')
+        if bndbox is not None:
+            bbox = tuple(_to_float(bndbox.findtext(tag)) for tag in ('xmin', 'ymin', 'xmax', 'ymax'))
+        vertices = []
+        for tag in XML_POLYGON_TAGS:
+            polygon = obj.find(tag)
+            if polygon is not None:
+                vertices = _parse_points(polygon.text or polygon.get('points', ''))
+                break
+        attributes = {}
+        for child in obj:
+            if child.tag not in XML_STRUCTURE_TAGS and len(child) == 0:
+                attributes[child.tag] = (child.text or '').strip()
+        objects.append((class_name, bbox, vertices, attributes))
+    return (root.findtext('filename') or '').strip(), int(width), int(height), objects
+
+
+def parse_annotation_objects(file_path):
+    """Return [[class_name, {attribute: value}], ...] for the objects in an XML or LabelMe JSON file"""
+    _, _, _, objects = read_annotation_file(file_path)
+    return [[class_name, attributes] for class_name, _, _, attributes in objects]
+
+
+class AnnotationIndex:
+    """Inverted indexes over an annotation folder: class -> objects and (attribute, value) -> objects
+
+    Parsed objects are persisted per file with their mtime, so reopening a folder only
+    re-parses files that changed. Writes through the API call update_file so queries
+    never need to rescan the folder.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = os.path.abspath(folder_path)
+        self.index_path = cache_path(self.folder_path, INDEX_FILE_NAME)
+        self.lock = threading.RLock()
+        self.next_object_id = 0
+        self._reset()
+        self._load()
+
+    def _load(self):
+        """Load persisted per-file objects, ignoring the cache if missing or from another version"""
+        data = load_cache(self.index_path, INDEX_VERSION)
+        if data is None:
+            return
+        try:
+            for name, entry in data.get('files', {}).items():
+                self._add_file(name, entry)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable annotation index {self.index_path}: {e}")
+            self._reset()
+
+    def _reset(self):
+        self.files = {}
+        # File names in sorted order, rebuilt lazily after files are added or removed
+        self.sorted_names = None
+        self.file_objects = {}
+        self.objects = {}
+        self.class_postings = {}
+        self.attr_postings = {}
+        self.attr_names = {}
+
+    def save(self):
+        """Persist the per-file objects atomically"""
+        with self.lock:
+            save_cache(self.index_path, INDEX_VERSION, {'files': self.files})
+
+    def _add_file(self, name, entry):
+        self.files[name] = entry
+        self.sorted_names = None
+        object_ids = []
+        for class_name, attributes in entry['objects']:
+            object_id = self.next_object_id
+            self.next_object_id += 1
+            self.objects[object_id] = (name, len(object_ids))
+            object_ids.append(object_id)
+            self.class_postings.setdefault(class_name, set()).add(object_id)
+            for attr_name, value in attributes.items():
+                self.attr_postings.setdefault((attr_name, value), set()).add(object_id)
+                self.attr_names.setdefault(attr_name, set()).add(object_id)
+        self.file_objects[name] = object_ids
+
+    def _remove_file(self, name):
+        entry = self.files.pop(name, None)
+        if entry is None:
+            return
+        self.sorted_names = None
+        for object_id, (class_name, attributes) in zip(self.file_objects.pop(name), entry['objects']):
+            del self.objects[object_id]
+            self._discard(self.class_postings, class_name, object_id)
+            for attr_name, value in attributes.items():
+                self._discard(self.attr_postings, (attr_name, value), object_id)
+                self._discard(self.attr_names, attr_name, object_id)
+
+    def _replace_file(self, name, entry):
+        """Re-index a file, keeping the cached name order when the file was already indexed"""
+        sorted_names = self.sorted_names if name in self.files else None
+        self._remove_file(name)
+        self._add_file(name, entry)
+        self.sorted_names = sorted_names
+
+    @staticmethod
+    def _discard(postings, key, object_id):
+        posting = postings.get(key)
+        if posting is not None:
+            posting.discard(object_id)
+            if not posting:
+                del postings[key]
+
+    def _parse_entry(self, file_path, stat):
+        try:
+            objects = parse_annotation_objects(file_path)
+        except Exception as e:
+            logger.warning(f"Error indexing annotation file {file_path}: {e}")
+            objects = []
+        return {'mtime': stat.st_mtime, 'size': stat.st_size, 'objects': objects}
+
+    def update_file(self, file_path):
+        """Re-index one annotation file after it was written (or drop it if it was deleted)
+
+        The persisted cache is not rewritten here; on the next load its stale mtime makes
+        refresh() re-parse the file anyway.
+        """
+        name = os.path.relpath(file_path, self.folder_path)
+        with self.lock:
+            if os.path.exists(file_path):
+                self._replace_file(name, self._parse_entry(file_path, os.stat(file_path)))
+            else:
+                self._remove_file(name)
+
+    def refresh(self):
+        """Re-index new or modified annotation files and drop deleted ones"""
+        with self.lock:
+            changed, present = scan_folder(self.folder_path, ANNOTATION_EXTENSIONS,
+                                           lambda name, stat: stat_matches(self.files.get(name), stat))
+            for name, stat in changed:
+                self._replace_file(name, self._parse_entry(os.path.join(self.folder_path, name), stat))
+            updated = len(changed)
+
+            removed = [name for name in self.files if name not in present]
+            for name in removed:
+                self._remove_file(name)
+
+            if updated or removed:
+                self.save()
+                logger.info(f"Annotation index refreshed: {updated} updated, {len(removed)} removed in {self.folder_path}")
+            return updated
+
+    def _evaluate(self, node, level):
+        """Evaluate a query node to a set of object ids (objects level) or file names (files level)"""
+        if not isinstance(node, dict) or len(node) == 0:
+            raise QueryError(f"Invalid query node: {node!r}")
+
+        keys = set(node)
+        if keys & {'and', 'or', 'not'}:
+            if len(keys) != 1:
+                raise QueryError(f"'and', 'or' and 'not' can't be combined with other keys: {node!r}")
+            operator = keys.pop()
+            if operator == 'not':
+                universe = self.objects.keys() if level == LEVEL_OBJECTS else self.files.keys()
+                return universe - self._evaluate(node['not'], level)
+            children = node[operator]
+            if not isinstance(children, list) or not children:
+                raise QueryError(f"'{operator}' needs a non-empty list of queries")
+            if operator == 'and':
+                negated = [child['not'] for child in children if isinstance(child, dict) and set(child) == {'not'}]
+                positive = [child for child in children if not (isinstance(child, dict) and set(child) == {'not'})]
+                if positive and negated:
+                    # "A and not B" is A - B, which never builds the complement of B
+                    matches = self._evaluate({'and': positive}, level)
+                    for child in negated:
+                        matches = matches.difference(self._evaluate(child, level))
+                    return matches
+            # Intersect smallest sets first
+            results = sorted((self._evaluate(child, level) for child in children), key=len)
+            if operator == 'and':
+                return set.intersection(*results)
+            return set.union(*results)
+
+        if 'class' in node:
+            if keys != {'class'}:
+                raise QueryError(f"Unexpected keys in class query: {node!r}")
+            if not isinstance(node['class'], str):
+                raise QueryError(f"'class' must be a string: {node!r}")
+            object_ids = self.class_postings.get(node['class'], set())
+        elif 'attr' in node:
+            attr_name = node['attr']
+            if not isinstance(attr_name, str):
+                raise QueryError(f"'attr' must be a string: {node!r}")
+            if len(keys - {'attr'}) > 1 or not keys - {'attr'} <= {'value', 'values', 'exists'}:
+                raise QueryError(f"Attribute query takes one of 'value', 'values' or 'exists': {node!r}")
+            if 'value' in node:
+                object_ids = self.attr_postings.get((attr_name, self._leaf_value(node['value'])), set())
+            elif 'values' in node:
+                if not isinstance(node['values'], list):
+                    raise QueryError(f"'values' must be a list: {node!r}")
+                object_ids = set()
+                for value in node['values']:
+                    object_ids |= self.attr_postings.get((attr_name, self._leaf_value(value)), set())
+            elif node.get('exists', True) is True:
+                object_ids = self.attr_names.get(attr_name, set())
+            elif node['exists'] is False:
+                object_ids = self.objects.keys() - self.attr_names.get(attr_name, set())
+            else:
+                raise QueryError(f"'exists' must be true or false: {node!r}")
+        else:
+            raise QueryError(f"Unknown query node: {node!r}")
+
+        if level == LEVEL_OBJECTS:
+            # Posting sets are returned as is; callers only read results
+            return object_ids
+        return {self.objects[object_id][0] for object_id in object_ids}
+
+    @staticmethod
+    def _leaf_value(value):
+        """Attribute values are indexed as strings; only scalars can be compared"""
+        if isinstance(value, (dict, list)) or value is None:
+            raise QueryError(f"Attribute values must be strings or numbers: {value!r}")
+        return str(value)
+
+    def query(self, query, level=LEVEL_OBJECTS, offset=0, limit=100, descending=False):
+        """Run a boolean query and return (total, page of result rows) sorted by file name
+
+        Query nodes: {"class": name}, {"attr": name, "value": v}, {"attr": name, "values": [...]},
+        {"attr": name, "exists": bool}, {"and": [...]}, {"or": [...]}, {"not": query}.
+        At the files level a leaf matches a file if any of its objects matches, so
+        {"and": [{"class": "X"}, {"not": {"class": "Y"}}]} finds images with X but no Y.
+        """
+        if level not in (LEVEL_OBJECTS, LEVEL_FILES):
+            raise QueryError(f"Unknown level: {level}")
+
+        with self.lock:
+            matches = self._evaluate(query, level) if query else (
+                self.objects.keys() if level == LEVEL_OBJECTS else self.files.keys())
+
+            if level == LEVEL_OBJECTS:
+                rows = []
+                for object_id in self._page(matches, len(self.objects), offset, limit, descending,
+                                         self._objects_in_order, key=self.objects.__getitem__):
+                    name, object_index = self.objects[object_id]
+                    class_name, attributes = self.files[name]['objects'][object_index]
+                    rows.append({
+                        'file': name,
+                        'object_index': object_index,
+                        'class': class_name,
+                        'attributes': attributes
+                    })
+            else:
+                rows = []
+                for name in self._page(matches, len(self.files), offset, limit, descending, self._files_in_order):
+                    objects = self.files[name]['objects']
+                    rows.append({
+                        'file': name,
+                        'object_count': len(objects),
+                        'classes': sorted({class_name for class_name, _ in objects})
+                    })
+
+            return len(matches), rows
+
+    def _files_in_order(self, descending):
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.files)
+        return reversed(self.sorted_names) if descending else iter(self.sorted_names)
+
+    def _objects_in_order(self, descending):
+        for name in self._files_in_order(descending):
+            object_ids = self.file_objects[name]
+            yield from reversed(object_ids) if descending else object_ids
+
+    def _page(self, matches, universe_size, offset, limit, descending, in_order, key=None):
+        """Return matches[offset:offset + limit] in (file name, object index) order without sorting all matches
+
+        Walking everything in order until the page is full visits about
+        (offset + limit) * universe_size / len(matches) items; that is used when it is cheaper
+        than sorting the matches, which is the case for large match sets.
+        """
+        wanted = offset + limit
+        if not matches or limit <= 0:
+            return []
+        if wanted * universe_size < len(matches) * len(matches):
+            page = []
+            for item in in_order(descending):
+                if item in matches:
+                    page.append(item)
+                    if len(page) >= wanted:
+                        break
+            return page[offset:]
+        if wanted * 8 > len(matches):
+            return sorted(matches, key=key, reverse=descending)[offset:wanted]
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return select(wanted, matches, key=key)[offset:]
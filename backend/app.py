@@ -1,10 +1,17 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import os
 import json
 import xml.etree.ElementTree as ET
 from pathlib import Path
 import logging
+import time
+from image_metadata import ImageMetadataIndex
+from snapshot_store import SnapshotStore
+from image_hashes import ImageHashIndex, HASH_TYPES, DEFAULT_THRESHOLD, MAX_THRESHOLD
+from annotation_index import AnnotationIndex, QueryError, LEVEL_OBJECTS
+from dataset_snapshot import DatasetSnapshot
+from jobs import Job, JobManager, JobQueueFull, FINISHED_STATES
 
 app = Flask(__name__)
 CORS(app)
@@ -18,6 +25,11 @@ class SmartQCBackend:
         self.current_config = None
         self.image_folder = None
         self.xml_folder = None
+        self.image_metadata_indexes = {}
+        self.snapshot_stores = {}
+        self.annotation_indexes = {}
+        self.image_hash_indexes = {}
+        self.dataset_snapshots = {}
         
     def load_config(self, config_path):
         """Load configuration from JSON file"""
@@ -29,7 +41,101 @@ class SmartQCBackend:
             logger.error(f"Error loading config: {e}")
             return False
     
-    def get_image_list(self, folder_path):
+    def get_image_metadata_index(self, folder_path, refresh=False):
+        """Get the image metadata index for a folder, building it on first use"""
+        folder_key = os.path.abspath(folder_path)
+        index = self.image_metadata_indexes.get(folder_key)
+        if index is None:
+            index = ImageMetadataIndex(folder_key)
+            index.refresh()
+            self.image_metadata_indexes[folder_key] = index
+        elif refresh:
+            index.refresh()
+        return index
+    
+    def get_image_hash_index(self, folder_path):
+        """Get the perceptual hash index for an image folder (call refresh() to hash new images)"""
+        folder_key = os.path.abspath(folder_path)
+        index = self.image_hash_indexes.get(folder_key)
+        if index is None:
+            index = ImageHashIndex(folder_key)
+            self.image_hash_indexes[folder_key] = index
+        return index
+    
+    def find_duplicate_images(self, folder_path, hash_type='dhash', threshold=DEFAULT_THRESHOLD, job=None):
+        """Hash new or modified images and group near-duplicates into clusters"""
+        job = job or Job('duplicates')
+        index = self.get_image_hash_index(folder_path)
+        index.refresh(job)
+        clusters = index.find_duplicate_clusters(hash_type, threshold)
+        
+        # Map every non-representative image to the first image of its cluster, so the listing can collapse them
+        duplicate_of = {}
+        for cluster in clusters:
+            for name in cluster[1:]:
+                duplicate_of[name] = cluster[0]
+        
+        return {
+            'clusters': clusters,
+            'duplicate_of': duplicate_of,
+            'cluster_count': len(clusters),
+            'duplicate_count': len(duplicate_of),
+            'hash': hash_type,
+            'threshold': threshold
+        }
+    
+    def get_snapshot_store(self, folder_path):
+        """Get the snapshot store recording annotation file versions for a folder"""
+        folder_key = os.path.abspath(folder_path)
+        store = self.snapshot_stores.get(folder_key)
+        if store is None:
+            store = SnapshotStore(folder_key)
+            self.snapshot_stores[folder_key] = store
+        return store
+    
+    def get_annotation_index(self, folder_path, refresh=False):
+        """Get the class/attribute query index for an annotation folder, building it on first use"""
+        folder_key = os.path.abspath(folder_path)
+        index = self.annotation_indexes.get(folder_key)
+        if index is None:
+            index = AnnotationIndex(folder_key)
+            index.refresh()
+            self.annotation_indexes[folder_key] = index
+        elif refresh:
+            index.refresh()
+        return index
+    
+    def get_dataset_snapshot(self, folder_path, refresh=False, job=None):
+        """Get the columnar snapshot of an annotation folder, building it on first use"""
+        folder_key = os.path.abspath(folder_path)
+        snapshot = self.dataset_snapshots.get(folder_key)
+        if snapshot is None:
+            snapshot = DatasetSnapshot(folder_key)
+            snapshot.refresh(job)
+            self.dataset_snapshots[folder_key] = snapshot
+        elif refresh:
+            snapshot.refresh(job)
+        return snapshot
+    
+    def annotation_written(self, file_path):
+        """Keep an already built query index and dataset snapshot in sync after an annotation file was written"""
+        folder_key = os.path.dirname(os.path.abspath(file_path))
+        index = self.annotation_indexes.get(folder_key)
+        if index is not None:
+            index.update_file(file_path)
+        snapshot = self.dataset_snapshots.get(folder_key)
+        if snapshot is not None:
+            snapshot.update_file(file_path)
+    
+    def annotations_changed(self, folder_path):
+        """Rescan an annotation folder whose files changed outside annotation_written (e.g. a rollback)"""
+        folder_key = os.path.abspath(folder_path)
+        if folder_key in self.annotation_indexes:
+            self.annotation_indexes[folder_key].refresh()
+        if folder_key in self.dataset_snapshots:
+            self.dataset_snapshots[folder_key].refresh()
+    
+    def get_image_list(self, folder_path, include_metadata=False):
         """Get list of images in folder"""
         image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif'}
         images = []
@@ -42,6 +148,12 @@ class SmartQCBackend:
                         'path': str(file_path),
                         'size': file_path.stat().st_size
                     })
+            
+            if include_metadata:
+                metadata = self.get_image_metadata_index(folder_path, refresh=True).lookup([image['name'] for image in images])
+                for image in images:
+                    image['metadata'] = metadata.get(image['name'])
+            
             return sorted(images, key=lambda x: x['name'])
         except Exception as e:
             logger.error(f"Error reading image folder: {e}")
@@ -177,8 +289,8 @@ class SmartQCBackend:
             logger.error(f"Error reading JSON file {json_path}: {e}")
             return None
     
-    def write_xml_file(self, xml_path, xml_data):
-        """Write XML data to file"""
+    def write_xml_file(self, xml_path, xml_data, operation=None):
+        """Write XML data to file, recording the previous version in the snapshot operation if given"""
         try:
             # Parse the XML data
             root = ET.fromstring(xml_data)
@@ -186,6 +298,8 @@ class SmartQCBackend:
             # Create tree and write to file
             tree = ET.ElementTree(root)
             ET.indent(tree, space="  ", level=0)  # Pretty formatting
+            if operation:
+                operation.record(xml_path)
             tree.write(xml_path, encoding='utf-8', xml_declaration=True)
             
             return True
@@ -193,9 +307,11 @@ class SmartQCBackend:
             logger.error(f"Error writing XML file {xml_path}: {e}")
             return False
     
-    def write_json_file(self, json_path, json_data):
-        """Write JSON data to file (LabelMe format)"""
+    def write_json_file(self, json_path, json_data, operation=None):
+        """Write JSON data to file (LabelMe format), recording the previous version in the snapshot operation if given"""
         try:
+            if operation:
+                operation.record(json_path)
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(json_data, f, indent=2, ensure_ascii=False)
             return True
@@ -203,8 +319,8 @@ class SmartQCBackend:
             logger.error(f"Error writing JSON file {json_path}: {e}")
             return False
     
-    def update_xml_attributes(self, xml_path, object_index, attributes):
-        """Update custom attributes in XML file"""
+    def update_xml_attributes(self, xml_path, object_index, attributes, operation=None):
+        """Update custom attributes in XML file, recording the previous version in the snapshot operation if given"""
         try:
             # Check if file exists and is not empty
             if not os.path.exists(xml_path) or os.path.getsize(xml_path) == 0:
@@ -228,6 +344,8 @@ class SmartQCBackend:
                 
                 # Write back to file
                 ET.indent(tree, space="  ", level=0)
+                if operation:
+                    operation.record(xml_path)
                 tree.write(xml_path, encoding='utf-8', xml_declaration=True)
                 return True
             else:
@@ -238,8 +356,260 @@ class SmartQCBackend:
             logger.error(f"Error updating XML attributes: {e}")
             return False
 
+    def collect_class_names(self, folder_path, job=None):
+        """Collect class names from all XML files (and classes.txt) in a folder"""
+        job = job or Job('class-names')
+        class_names = set()
+        
+        # Read all XML files in the folder
+        xml_paths = [file_path for file_path in Path(folder_path).iterdir() if file_path.suffix.lower() == '.xml']
+        job.set_total(len(xml_paths))
+        
+        for file_path in xml_paths:
+            job.check_cancelled()
+            try:
+                # Check if file is empty
+                if file_path.stat().st_size == 0:
+                    logger.info(f"Skipping empty XML file: {file_path}")
+                    continue
+                    
+                tree = ET.parse(file_path)
+                root = tree.getroot()
+                
+                # Extract class names from object elements
+                for obj in root.findall('object'):
+                    name_elem = obj.find('name')
+                    if name_elem is not None and name_elem.text:
+                        class_names.add(name_elem.text.strip())
+                        
+            except ET.ParseError as e:
+                logger.warning(f"Error parsing XML file {file_path}: {e}")
+                job.add_error(f"Error parsing XML {file_path.name}: {str(e)}")
+            except Exception as e:
+                logger.warning(f"Error reading XML file {file_path}: {e}")
+                job.add_error(f"Error reading XML {file_path.name}: {str(e)}")
+            finally:
+                job.advance()
+        
+        # Also check for classes.txt file
+        classes_file = Path(folder_path) / 'classes.txt'
+        if classes_file.exists():
+            try:
+                with open(classes_file, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            class_names.add(line)
+            except Exception as e:
+                logger.warning(f"Error reading classes.txt: {e}")
+        
+        return sorted(list(class_names))
+    
+    def apply_default_attributes(self, folder_path, images_folder_path, qc_type, asset_type, file_format,
+                                 asset_attributes_list, job=None):
+        """Add missing default attributes to every object in the existing annotation files of a folder"""
+        job = job or Job('save-default-attributes')
+        files_processed = 0
+        files_updated = 0
+        
+        logger.info(f"Processing existing annotation files for {asset_type} in {qc_type} mode")
+        logger.info(f"Annotation folder: {folder_path}")
+        logger.info(f"Images folder: {images_folder_path}")
+        logger.info(f"File format: {file_format}")
+        
+        suffix = '.json' if file_format == 'json' else '.xml'
+        file_paths = []
+        if file_format in ('xml', 'json'):
+            file_paths = [file_path for file_path in Path(folder_path).iterdir()
+                          if file_path.suffix.lower() == suffix and file_path.stat().st_size > 0]
+        job.set_total(len(file_paths))
+        
+        # Record every file version before it is overwritten, so the whole run can be rolled back
+        # (the manifest is saved even if the job is cancelled or fails half way)
+        with self.get_snapshot_store(folder_path).begin_operation(
+                'save-default-attributes', f"Default attributes for {asset_type} in {qc_type} mode") as operation:
+            
+            if file_format == 'xml':
+                # Process existing XML files only
+                for file_path in file_paths:
+                    job.check_cancelled()
+                    try:
+                        # Read existing XML file
+                        tree = ET.parse(file_path)
+                        root = tree.getroot()
+                        
+                        # Check if this XML has any objects
+                        objects = root.findall('object')
+                        if len(objects) > 0:
+                            logger.info(f"Processing XML file with {len(objects)} objects: {file_path}")
+                            
+                            # Process each object in the XML
+                            for obj in objects:
+                                # Add default attributes if they don't exist
+                                for attr_config in asset_attributes_list:
+                                    attr_name = attr_config['name']
+                                    attr_elem = obj.find(attr_name)
+                                    if attr_elem is None:
+                                        # Add new attribute with default value
+                                        attr_elem = ET.SubElement(obj, attr_name)
+                                        default_value = attr_config.get('default', '')
+                                        attr_elem.text = str(default_value)
+                                        logger.info(f"Added attribute {attr_name}={default_value} to object in {file_path.name}")
+                                    
+                            # Write updated XML back to file
+                            ET.indent(tree, space="  ", level=0)
+                            operation.record(file_path)
+                            tree.write(file_path, encoding='utf-8', xml_declaration=True)
+                            self.annotation_written(file_path)
+                            files_updated += 1
+                        else:
+                            logger.info(f"Skipping XML file with no objects: {file_path}")
+                        
+                        files_processed += 1
+                        
+                    except Exception as e:
+                        error_msg = f"Error processing XML {file_path.name}: {str(e)}"
+                        job.add_error(error_msg)
+                        logger.error(error_msg)
+                    job.advance()
+                        
+            elif file_format == 'json':
+                # Process existing JSON files only
+                for file_path in file_paths:
+                    job.check_cancelled()
+                    try:
+                        # Read existing JSON file
+                        with open(file_path, 'r', encoding='utf-8') as f:
+                            json_data = json.load(f)
+                        
+                        # Check if this JSON has any shapes
+                        shapes = json_data.get('shapes', [])
+                        if len(shapes) > 0:
+                            logger.info(f"Processing JSON file with {len(shapes)} shapes: {file_path}")
+                            
+                            # Process each shape in the JSON
+                            for shape in shapes:
+                                # Add default attributes if they don't exist
+                                for attr_config in asset_attributes_list:
+                                    attr_name = attr_config['name']
+                                    if attr_name not in shape:
+                                        # Add new attribute with default value
+                                        default_value = attr_config.get('default', '')
+                                        shape[attr_name] = str(default_value)
+                                        logger.info(f"Added attribute {attr_name}={default_value} to shape in {file_path.name}")
+                            
+                            # Write updated JSON back to file
+                            operation.record(file_path)
+                            with open(file_path, 'w', encoding='utf-8') as f:
+                                json.dump(json_data, f, indent=2, ensure_ascii=False)
+                            self.annotation_written(file_path)
+                            files_updated += 1
+                        else:
+                            logger.info(f"Skipping JSON file with no shapes: {file_path}")
+                        
+                        files_processed += 1
+                        
+                    except Exception as e:
+                        error_msg = f"Error processing JSON {file_path.name}: {str(e)}"
+                        job.add_error(error_msg)
+                        logger.error(error_msg)
+                    job.advance()
+            
+            # Create a summary file with the selected configuration
+            config_summary = {
+                "qc_type": qc_type,
+                "asset_type": asset_type,
+                "attributes": asset_attributes_list,
+                "file_format": file_format,
+                "timestamp": str(Path().cwd()),
+                "files_processed": files_processed,
+                "files_updated": files_updated,
+                "annotation_folder": folder_path,
+                "images_folder": images_folder_path
+            }
+            
+            config_path = Path(folder_path) / f"{qc_type}_{asset_type}_config.json"
+            try:
+                operation.record(config_path)
+                with open(config_path, 'w', encoding='utf-8') as f:
+                    json.dump(config_summary, f, indent=2, ensure_ascii=False)
+                logger.info(f"Created configuration summary: {config_path}")
+            except Exception as e:
+                logger.warning(f"Failed to create config summary: {e}")
+        
+        message = f"Successfully processed {files_processed} annotation files and updated {files_updated} files with default attributes for {asset_type} in {qc_type} mode"
+        
+        return {
+            'success': True,
+            'files_processed': files_processed,
+            'files_updated': files_updated,
+            'errors': list(job.errors),
+            'message': message,
+            'operation_id': operation.id
+        }
+    
+    def build_report(self, folder_path, job=None):
+        """Collect the objects of every XML file in a folder into a QC report, from the dataset snapshot"""
+        job = job or Job('export-report')
+        # Only files changed since the snapshot was built are parsed again
+        snapshot = self.get_dataset_snapshot(folder_path, refresh=True, job=job)
+        attribute_names = [attr['name'] for attr in (self.current_config or {}).get('attributes', [])]
+        report_data = []
+        
+        for xml_file in self.get_xml_list(folder_path):
+            job.check_cancelled()
+            exported = snapshot.export_file(xml_file['name'])
+            if exported is None or exported['error']:
+                job.add_error(f"Error reading XML {xml_file['name']}: {exported['error'] if exported else 'not found'}")
+                continue
+            if exported['size'] == 0:
+                logger.warning(f"XML file is empty: {xml_file['name']}")
+                continue
+            
+            objects = []
+            for row in exported['objects']:
+                # Empty <name/> and attribute elements are reported as None, as read_xml_file does
+                obj_data = {'name': row['class'] or None}
+                if row['bbox'] is not None:
+                    obj_data['bndbox'] = dict(zip(('xmin', 'ymin', 'xmax', 'ymax'), (int(value) for value in row['bbox'])))
+                for attr_name in attribute_names:
+                    if attr_name in row['attributes']:
+                        obj_data[attr_name] = row['attributes'][attr_name] or None
+                objects.append(obj_data)
+            
+            report_data.append({
+                'filename': xml_file['name'],
+                'image_filename': exported['image_filename'],
+                'object_count': len(objects),
+                'objects': objects
+            })
+        
+        return {
+            'report': report_data,
+            'summary': {
+                'total_files': len(report_data),
+                'total_objects': sum(len(item['objects']) for item in report_data)
+            }
+        }
+
 # Initialize backend
 backend = SmartQCBackend()
+job_manager = JobManager()
+SSE_MIN_INTERVAL = 0.25
+
+def run_as_job_or_inline(kind, func, description=''):
+    """Run func(job) and return its result as JSON, or queue it as a background job when the request asks for async"""
+    data = request.get_json(silent=True) or {}
+    run_async = data.get('async') or request.args.get('async', '').lower() in ('1', 'true', 'yes')
+    
+    if not run_async:
+        return jsonify(func(Job(kind, description)))
+    
+    try:
+        job = job_manager.submit(kind, func, description)
+    except JobQueueFull as e:
+        return jsonify({'error': f'Too many background jobs: {e}'}), 503
+    return jsonify({'job_id': job.id, 'status': job.status}), 202
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -252,6 +622,7 @@ def load_folders():
     data = request.json
     image_folder = data.get('image_folder')
     xml_folder = data.get('xml_folder')
+    include_metadata = data.get('include_metadata', False)
     
     if not image_folder or not os.path.exists(image_folder):
         return jsonify({'error': 'Invalid image folder'}), 400
@@ -263,7 +634,7 @@ def load_folders():
     backend.xml_folder = xml_folder
     
     # Get file lists
-    images = backend.get_image_list(image_folder)
+    images = backend.get_image_list(image_folder, include_metadata=include_metadata)
     xml_files = backend.get_xml_list(xml_folder)
     
     return jsonify({
@@ -298,6 +669,7 @@ def set_folders():
 def get_images():
     """Get list of images from folder"""
     folder = request.args.get('folder')
+    include_metadata = request.args.get('include_metadata', '').lower() in ('1', 'true', 'yes')
     if not folder:
         folder = backend.image_folder
     
@@ -311,11 +683,36 @@ def get_images():
         for filename in os.listdir(folder):
             if any(filename.lower().endswith(ext) for ext in image_extensions):
                 images.append(filename)
-        return jsonify({'images': sorted(images)})
+        
+        result = {'images': sorted(images)}
+        if include_metadata:
+            # Dimensions/EXIF keyed by image name, so the frontend doesn't have to load each image
+            result['metadata'] = backend.get_image_metadata_index(folder, refresh=True).lookup(images)
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Error reading images folder: {e}")
         return jsonify({'error': 'Failed to read folder'}), 500
 
+@app.route('/api/image-metadata', methods=['POST'])
+def get_image_metadata():
+    """Batch lookup of image dimensions, EXIF timestamp, GPS and orientation"""
+    data = request.json or {}
+    folder = data.get('folder') or backend.image_folder
+    filenames = data.get('filenames')
+    # The index is refreshed when the image listing loads; pages of lookups only read it
+    refresh = bool(data.get('refresh', False))
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    try:
+        index = backend.get_image_metadata_index(folder, refresh=refresh)
+        metadata = index.lookup(filenames) if filenames is not None else index.all()
+        return jsonify({'metadata': metadata})
+    except Exception as e:
+        logger.error(f"Error reading image metadata: {e}")
+        return jsonify({'error': 'Failed to read image metadata'}), 500
+
 @app.route('/api/get-xmls')
 def get_xmls():
     """Get list of XML files from folder"""
@@ -474,8 +871,12 @@ def save_xml():
     image_basename = os.path.splitext(filename)[0]
     xml_path = os.path.join(backend.xml_folder, f"{image_basename}.xml")
     
-    if backend.write_xml_file(xml_path, xml_content):
-        return jsonify({'success': True})
+    with backend.get_snapshot_store(backend.xml_folder).begin_operation('save-xml', filename) as operation:
+        saved = backend.write_xml_file(xml_path, xml_content, operation=operation)
+    
+    if saved:
+        backend.annotation_written(xml_path)
+        return jsonify({'success': True, 'operation_id': operation.id})
     else:
         return jsonify({'error': 'Failed to save XML file'}), 500
 
@@ -493,8 +894,12 @@ def save_json():
     image_basename = os.path.splitext(filename)[0]
     json_path = os.path.join(backend.xml_folder, f"{image_basename}.json")
     
-    if backend.write_json_file(json_path, json_content):
-        return jsonify({'success': True})
+    with backend.get_snapshot_store(backend.xml_folder).begin_operation('save-json', filename) as operation:
+        saved = backend.write_json_file(json_path, json_content, operation=operation)
+    
+    if saved:
+        backend.annotation_written(json_path)
+        return jsonify({'success': True, 'operation_id': operation.id})
     else:
         return jsonify({'error': 'Failed to save JSON file'}), 500
 
@@ -514,8 +919,12 @@ def update_attributes():
     xml_path = os.path.join(backend.xml_folder, f"{image_basename}.xml")
     
     if os.path.exists(xml_path):
-        if backend.update_xml_attributes(xml_path, object_index, attributes):
-            return jsonify({'success': True})
+        with backend.get_snapshot_store(backend.xml_folder).begin_operation('update-attributes', filename) as operation:
+            updated = backend.update_xml_attributes(xml_path, object_index, attributes, operation=operation)
+        
+        if updated:
+            backend.annotation_written(xml_path)
+            return jsonify({'success': True, 'operation_id': operation.id})
         else:
             return jsonify({'error': 'Failed to update attributes'}), 500
     else:
@@ -535,48 +944,13 @@ def get_class_names():
     if not backend.xml_folder:
         return jsonify({'error': 'XML folder not set'}), 400
     
-    class_names = set()
-    
+    xml_folder = backend.xml_folder
     try:
-        # Read all XML files in the folder
-        for file_path in Path(backend.xml_folder).iterdir():
-            if file_path.suffix.lower() == '.xml':
-                try:
-                    # Check if file is empty
-                    if file_path.stat().st_size == 0:
-                        logger.info(f"Skipping empty XML file: {file_path}")
-                        continue
-                        
-                    tree = ET.parse(file_path)
-                    root = tree.getroot()
-                    
-                    # Extract class names from object elements
-                    for obj in root.findall('object'):
-                        name_elem = obj.find('name')
-                        if name_elem is not None and name_elem.text:
-                            class_names.add(name_elem.text.strip())
-                            
-                except ET.ParseError as e:
-                    logger.warning(f"Error parsing XML file {file_path}: {e}")
-                    continue
-                except Exception as e:
-                    logger.warning(f"Error reading XML file {file_path}: {e}")
-                    continue
-        
-        # Also check for classes.txt file
-        classes_file = Path(backend.xml_folder) / 'classes.txt'
-        if classes_file.exists():
-            try:
-                with open(classes_file, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            class_names.add(line)
-            except Exception as e:
-                logger.warning(f"Error reading classes.txt: {e}")
-        
-        return jsonify({'class_names': sorted(list(class_names))})
-        
+        return run_as_job_or_inline(
+            'class-names',
+            lambda job: {'class_names': backend.collect_class_names(xml_folder, job)},
+            f"Class names in {xml_folder}"
+        )
     except Exception as e:
         logger.error(f"Error getting class names: {e}")
         return jsonify({'error': 'Failed to get class names'}), 500
@@ -627,164 +1001,244 @@ def save_default_attributes():
         return jsonify({'error': 'Failed to load asset configuration'}), 500
 
     try:
-        files_processed = 0
-        files_updated = 0
-        errors = []
-        
-        logger.info(f"Processing existing annotation files for {asset_type} in {qc_type} mode")
-        logger.info(f"Annotation folder: {folder_path}")
-        logger.info(f"Images folder: {images_folder_path}")
-        logger.info(f"File format: {file_format}")
-        
-        if file_format == 'xml':
-            # Process existing XML files only
-            for file_path in Path(folder_path).iterdir():
-                if file_path.suffix.lower() == '.xml' and file_path.stat().st_size > 0:
-                    try:
-                        # Read existing XML file
-                        tree = ET.parse(file_path)
-                        root = tree.getroot()
-                        
-                        # Check if this XML has any objects
-                        objects = root.findall('object')
-                        if len(objects) > 0:
-                            logger.info(f"Processing XML file with {len(objects)} objects: {file_path}")
-                            
-                            # Process each object in the XML
-                            for obj in objects:
-                                # Add default attributes if they don't exist
-                                for attr_config in asset_attributes_list:
-                                    attr_name = attr_config['name']
-                                    attr_elem = obj.find(attr_name)
-                                    if attr_elem is None:
-                                        # Add new attribute with default value
-                                        attr_elem = ET.SubElement(obj, attr_name)
-                                        default_value = attr_config.get('default', '')
-                                        attr_elem.text = str(default_value)
-                                        logger.info(f"Added attribute {attr_name}={default_value} to object in {file_path.name}")
-                                    
-                            # Write updated XML back to file
-                            ET.indent(tree, space="  ", level=0)
-                            tree.write(file_path, encoding='utf-8', xml_declaration=True)
-                            files_updated += 1
-                        else:
-                            logger.info(f"Skipping XML file with no objects: {file_path}")
-                        
-                        files_processed += 1
-                        
-                    except Exception as e:
-                        error_msg = f"Error processing XML {file_path.name}: {str(e)}"
-                        errors.append(error_msg)
-                        logger.error(error_msg)
-                        
-        elif file_format == 'json':
-            # Process existing JSON files only
-            for file_path in Path(folder_path).iterdir():
-                if file_path.suffix.lower() == '.json' and file_path.stat().st_size > 0:
-                    try:
-                        # Read existing JSON file
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            json_data = json.load(f)
-                        
-                        # Check if this JSON has any shapes
-                        shapes = json_data.get('shapes', [])
-                        if len(shapes) > 0:
-                            logger.info(f"Processing JSON file with {len(shapes)} shapes: {file_path}")
-                            
-                            # Process each shape in the JSON
-                            for shape in shapes:
-                                # Add default attributes if they don't exist
-                                for attr_config in asset_attributes_list:
-                                    attr_name = attr_config['name']
-                                    if attr_name not in shape:
-                                        # Add new attribute with default value
-                                        default_value = attr_config.get('default', '')
-                                        shape[attr_name] = str(default_value)
-                                        logger.info(f"Added attribute {attr_name}={default_value} to shape in {file_path.name}")
-                            
-                            # Write updated JSON back to file
-                            with open(file_path, 'w', encoding='utf-8') as f:
-                                json.dump(json_data, f, indent=2, ensure_ascii=False)
-                            files_updated += 1
-                        else:
-                            logger.info(f"Skipping JSON file with no shapes: {file_path}")
-                        
-                        files_processed += 1
-                        
-                    except Exception as e:
-                        error_msg = f"Error processing JSON {file_path.name}: {str(e)}"
-                        errors.append(error_msg)
-                        logger.error(error_msg)
-        
-        # Create a summary file with the selected configuration
-        config_summary = {
-            "qc_type": qc_type,
-            "asset_type": asset_type,
-            "attributes": asset_attributes_list,
-            "file_format": file_format,
-            "timestamp": str(Path().cwd()),
-            "files_processed": files_processed,
-            "files_updated": files_updated,
-            "annotation_folder": folder_path,
-            "images_folder": images_folder_path
-        }
-        
-        config_path = Path(folder_path) / f"{qc_type}_{asset_type}_config.json"
-        try:
-            with open(config_path, 'w', encoding='utf-8') as f:
-                json.dump(config_summary, f, indent=2, ensure_ascii=False)
-            logger.info(f"Created configuration summary: {config_path}")
-        except Exception as e:
-            logger.warning(f"Failed to create config summary: {e}")
-        
-        message = f"Successfully processed {files_processed} annotation files and updated {files_updated} files with default attributes for {asset_type} in {qc_type} mode"
-        
-        return jsonify({
-            'success': True,
-            'files_processed': files_processed,
-            'files_updated': files_updated,
-            'errors': errors,
-            'message': message
-        })
-        
+        return run_as_job_or_inline(
+            'save-default-attributes',
+            lambda job: backend.apply_default_attributes(
+                folder_path, images_folder_path, qc_type, asset_type, file_format, asset_attributes_list, job),
+            f"Default attributes for {asset_type} in {qc_type} mode"
+        )
     except Exception as e:
         logger.error(f"Error processing default attributes: {e}")
         return jsonify({'error': f'Failed to process default attributes: {str(e)}'}), 500
 
+@app.route('/api/duplicates', methods=['GET'])
+def get_duplicates():
+    """Find clusters of near-duplicate images (e.g. consecutive frames of a drive sequence)"""
+    folder = request.args.get('folder') or backend.image_folder
+    hash_type = request.args.get('hash', 'dhash')
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    if hash_type not in HASH_TYPES:
+        return jsonify({'error': f'Unsupported hash: {hash_type}'}), 400
+    
+    try:
+        threshold = int(request.args.get('threshold', DEFAULT_THRESHOLD))
+    except ValueError:
+        return jsonify({'error': 'Invalid threshold'}), 400
+    
+    if not 0 <= threshold <= MAX_THRESHOLD:
+        return jsonify({'error': f'Threshold must be between 0 and {MAX_THRESHOLD}'}), 400
+    
+    try:
+        return run_as_job_or_inline(
+            'duplicates',
+            lambda job: backend.find_duplicate_images(folder, hash_type, threshold, job),
+            f"Near-duplicate images in {folder}"
+        )
+    except Exception as e:
+        logger.error(f"Error finding duplicate images: {e}")
+        return jsonify({'error': 'Failed to find duplicate images'}), 500
+
+@app.route('/api/snapshots', methods=['GET'])
+def list_snapshots():
+    """List recorded snapshot operations for the annotation folder, newest first"""
+    folder = request.args.get('folder') or backend.xml_folder
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    store = backend.get_snapshot_store(folder)
+    return jsonify({
+        'operations': store.list_operations(),
+        'disk_usage': store.disk_usage(),
+        'max_bytes': store.max_bytes
+    })
+
+@app.route('/api/snapshots/rollback', methods=['POST'])
+def rollback_snapshot():
+    """Roll back a whole snapshot operation, or a single file from it"""
+    data = request.json or {}
+    folder = data.get('folder') or backend.xml_folder
+    operation_id = data.get('operation_id')
+    filename = data.get('filename')
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    if not operation_id:
+        return jsonify({'error': 'Missing required parameters'}), 400
+    
+    try:
+        result = backend.get_snapshot_store(folder).rollback(operation_id, filename)
+        backend.annotations_changed(folder)
+    except Exception as e:
+        logger.error(f"Error rolling back snapshot operation {operation_id}: {e}")
+        return jsonify({'error': f'Failed to roll back operation: {str(e)}'}), 500
+    
+    if result is None:
+        return jsonify({'error': 'Snapshot operation or file not found'}), 404
+    
+    files_restored, errors, rollback_operation_id = result
+    return jsonify({
+        'success': not errors,
+        'files_restored': files_restored,
+        'errors': errors,
+        'operation_id': rollback_operation_id
+    })
+
+@app.route('/api/snapshots/prune', methods=['POST'])
+def prune_snapshots():
+    """Drop the oldest snapshot operations until the store fits its disk budget"""
+    data = request.json or {}
+    folder = data.get('folder') or backend.xml_folder
+    max_bytes = data.get('max_bytes')
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    if max_bytes is not None:
+        try:
+            max_bytes = int(max_bytes)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid max_bytes'}), 400
+        if max_bytes < 0:
+            return jsonify({'error': 'Invalid max_bytes'}), 400
+    
+    store = backend.get_snapshot_store(folder)
+    operations_removed = store.prune(max_bytes)
+    return jsonify({
+        'success': True,
+        'operations_removed': operations_removed,
+        'disk_usage': store.disk_usage()
+    })
+
 @app.route('/api/export-report', methods=['POST'])
 def export_report():
     """Export QC report"""
-    data = request.json
+    data = request.json or {}
     format_type = data.get('format', 'json')
     
     if not backend.xml_folder:
         return jsonify({'error': 'XML folder not set'}), 400
     
-    # Collect all XML data
-    xml_files = backend.get_xml_list(backend.xml_folder)
-    report_data = []
+    if format_type != 'json':
+        # Could add CSV, Excel export here
+        return jsonify({'error': 'Unsupported format'}), 400
     
-    for xml_file in xml_files:
-        xml_data = backend.read_xml_file(xml_file['path'])
-        if xml_data:
-            report_data.append({
-                'filename': xml_file['name'],
-                'image_filename': xml_data['filename'],
-                'object_count': len(xml_data['objects']),
-                'objects': xml_data['objects']
-            })
+    xml_folder = backend.xml_folder
+    return run_as_job_or_inline(
+        'export-report',
+        lambda job: backend.build_report(xml_folder, job),
+        f"QC report for {xml_folder}"
+    )
+
+@app.route('/api/query', methods=['POST'])
+def query_annotations():
+    """Query objects or files by class and attribute values, paged and sorted by file name"""
+    data = request.json or {}
+    folder = data.get('folder') or backend.xml_folder
+    query = data.get('query')
+    level = data.get('level', LEVEL_OBJECTS)
+    sort = data.get('sort', 'file')
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
+    
+    try:
+        offset = max(int(data.get('offset', 0)), 0)
+        limit = max(int(data.get('limit', 100)), 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid offset or limit'}), 400
+    
+    if sort not in ('file', '-file'):
+        return jsonify({'error': f'Unsupported sort: {sort}'}), 400
+    
+    try:
+        index = backend.get_annotation_index(folder, refresh=data.get('refresh', False))
+        total, results = index.query(query, level, offset, limit, descending=sort == '-file')
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error querying annotations: {e}")
+        return jsonify({'error': 'Failed to query annotations'}), 500
+    
+    return jsonify({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'level': level,
+        'results': results
+    })
+
+@app.route('/api/dataset-stats', methods=['GET'])
+def get_dataset_stats():
+    """Object counts per class and attribute value for the annotation folder, from the columnar snapshot"""
+    folder = request.args.get('folder') or backend.xml_folder
+    class_name = request.args.get('class')
+    
+    if not folder or not os.path.exists(folder):
+        return jsonify({'error': 'Folder not found'}), 404
     
-    if format_type == 'json':
+    try:
+        snapshot = backend.get_dataset_snapshot(folder, refresh=request.args.get('refresh', '').lower() in ('1', 'true', 'yes'))
         return jsonify({
-            'report': report_data,
-            'summary': {
-                'total_files': len(report_data),
-                'total_objects': sum(len(item['objects']) for item in report_data)
-            }
+            **snapshot.stats(class_name),
+            'memory': snapshot.memory_usage()
         })
-    else:
-        # Could add CSV, Excel export here
-        return jsonify({'error': 'Unsupported format'}), 400
+    except Exception as e:
+        logger.error(f"Error computing dataset stats: {e}")
+        return jsonify({'error': 'Failed to compute dataset stats'}), 500
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """List background jobs, newest first"""
+    return jsonify({'jobs': job_manager.list_jobs()})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get progress, errors and (once finished) the result of a background job"""
+    job_data = job_manager.get_dict(job_id)
+    if job_data is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_data)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream job progress as server-sent events until the job finishes"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        version = -1
+        while True:
+            new_version = job.wait_for_change(version, timeout=15)
+            if new_version == version:
+                # Keep the connection alive while nothing changes
+                yield ': keep-alive\n\n'
+                continue
+            version = new_version
+            if job.status in FINISHED_STATES:
+                # The result of a finished job is only kept on disk
+                yield f"data: {json.dumps(job_manager.get_dict(job.id))}\n\n"
+                break
+            job_data = job.to_dict()
+            del job_data['result']
+            yield f"data: {json.dumps(job_data)}\n\n"
+            # Coalesce per-file updates into a few events per second
+            time.sleep(SSE_MIN_INTERVAL)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Request cancellation of a background job; it stops after the current file"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, 'status': job.status, 'cancel_requested': job.cancel_requested})
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
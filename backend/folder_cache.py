@@ -0,0 +1,68 @@
+import os
+import json
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Directory (inside a data folder) holding Smart QC caches and indexes
+CACHE_DIR_NAME = '.smartqc'
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif'}
+ANNOTATION_EXTENSIONS = {'.xml', '.json'}
+
+
+def cache_path(folder_path, file_name):
+    """Path of a cache file inside a data folder's cache directory"""
+    return Path(folder_path) / CACHE_DIR_NAME / file_name
+
+
+def load_cache(path, version):
+    """Load a persisted cache, returning None if it is missing, unreadable or from another version"""
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cache {path}: {e}")
+        return None
+    if data.get('version') != version:
+        return None
+    return data
+
+
+def save_cache(path, version, data):
+    """Persist a cache atomically; failures are logged, since a cache can always be rebuilt"""
+    try:
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': version, **data}, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"Failed to save cache {path}: {e}")
+
+
+def stat_matches(entry, stat):
+    """Whether a cached {'mtime', 'size', ...} entry still describes a file"""
+    return entry is not None and entry.get('mtime') == stat.st_mtime and entry.get('size') == stat.st_size
+
+
+def scan_folder(folder_path, extensions, is_current):
+    """Stat the files of a folder with the given extensions
+
+    Returns (changed, present): changed lists (name, stat) of files for which is_current(name, stat)
+    is false, and present is the set of all matching names, for dropping deleted files.
+    """
+    changed = []
+    present = set()
+    with os.scandir(folder_path) as it:
+        for dir_entry in it:
+            if not dir_entry.is_file() or os.path.splitext(dir_entry.name)[1].lower() not in extensions:
+                continue
+            present.add(dir_entry.name)
+            stat = dir_entry.stat()
+            if not is_current(dir_entry.name, stat):
+                changed.append((dir_entry.name, stat))
+    return changed, present
@@ -0,0 +1,326 @@
+import os
+import itertools
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+from folder_cache import IMAGE_EXTENSIONS, cache_path, load_cache, save_cache, stat_matches, scan_folder
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'image_hashes.json'
+INDEX_VERSION = 1
+
+HASH_TYPES = ('dhash', 'phash')
+DEFAULT_THRESHOLD = 6
+
+# Multi-index hashing: 64-bit hashes are looked up by four 16-bit chunks
+CHUNK_COUNT = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# Radius per chunk is threshold // CHUNK_COUNT; 11 keeps it at 2 (137 flip patterns per chunk)
+MAX_THRESHOLD = 11
+# Buckets holding more hashes than this (e.g. many frames with a blown-out sky share a zero top chunk)
+# are not joined, since that would compare all their pairs; their hashes are searched again on the other chunks
+BUCKET_LIMIT = 128
+# Largest per-chunk radius used when searching crowded hashes on fewer chunks
+MAX_RADIUS = 2
+# Candidate pairs materialized at once
+PAIR_BLOCK = 1 << 20
+# Hashes close to more hashes than this (near-blank images) stop collecting pairs and are clustered by _greedy_pairs
+DEGREE_LIMIT = 64
+
+PHASH_SIZE = 32
+PHASH_LOW = 8
+
+# Number of set bits for every byte value, for vectorized popcount
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(size):
+    """Orthonormal DCT-II matrix, so dct(x) = M @ x @ M.T"""
+    k = np.arange(size).reshape(-1, 1)
+    n = np.arange(size).reshape(1, -1)
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SIZE)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def compute_image_hashes(image_path):
+    """Return (dhash, phash) of an image as 64-bit integers"""
+    with Image.open(image_path) as img:
+        # For JPEGs, draft() lets the decoder downscale while decoding, which is much cheaper
+        img.draft('L', (PHASH_SIZE * 2, PHASH_SIZE * 2))
+        gray = img.convert('L')
+
+    # dHash: is each pixel brighter than its right neighbour, on a 9x8 thumbnail
+    small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits_to_int(small[:, 1:] > small[:, :-1])
+
+    # pHash: low frequency DCT coefficients compared to their median
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:PHASH_LOW, :PHASH_LOW]
+    phash = _bits_to_int(low > np.median(low.flatten()[1:]))
+
+    return dhash, phash
+
+
+def _hash_worker(image_path):
+    """Process pool entry point; returns an error message instead of raising"""
+    try:
+        return compute_image_hashes(image_path), None
+    except Exception as e:
+        return None, str(e)
+
+
+def hamming_distances(left, right):
+    """Vectorized element-wise Hamming distances between two equal-length arrays of uint64 hashes"""
+    xor = np.ascontiguousarray(np.bitwise_xor(left, right))
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _flip_masks(radius):
+    """All CHUNK_BITS-bit masks with at most `radius` bits set"""
+    return [sum(1 << bit for bit in bits)
+            for flips in range(radius + 1)
+            for bits in itertools.combinations(range(CHUNK_BITS), flips)]
+
+
+def _blocks(sizes):
+    """Split positions into consecutive (start, stop) ranges whose sizes add up to about PAIR_BLOCK"""
+    ends = np.cumsum(sizes)
+    start = 0
+    while start < len(sizes):
+        base = ends[start - 1] if start else 0
+        stop = max(int(np.searchsorted(ends, base + PAIR_BLOCK, side='right')), start + 1)
+        yield start, stop
+        start = stop
+
+
+def _near_pairs(hashes, members, chunks, threshold, rank, degrees):
+    """Yield (rows, cols) arrays of pairs of `members` (indices into hashes) within `threshold` bits
+
+    Multi-index hashing on the given chunks: two hashes within `threshold` bits have at least one
+    of these chunks within threshold // len(chunks) bits. Each chunk and bit-flip pattern is a
+    bucket-table join on chunk values, processed in blocks of PAIR_BLOCK candidates. Joins into
+    crowded buckets (more than BUCKET_LIMIT hashes) are skipped; a pair is only missed that way
+    when both its chunk values are crowded, so those hashes are searched again on the remaining
+    chunks, or by _greedy_pairs once no chunks are left. Pairs may be yielded more than once.
+
+    `degrees` counts the pairs yielded per hash and is updated in place; hashes over DEGREE_LIMIT
+    are no longer searched and their pairs are left out, for the caller to cluster them greedily.
+    """
+    radius = threshold // len(chunks)
+    flip_masks = _flip_masks(radius)
+    values = hashes[members]
+    keys = {}
+    crowded = {}
+    for chunk in chunks:
+        keys[chunk] = ((values >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.int64)
+        crowded[chunk] = np.bincount(keys[chunk], minlength=CHUNK_MASK + 1) > BUCKET_LIMIT
+
+    for chunk in chunks:
+        chunk_keys = keys[chunk]
+        # Bucket table over all 2^16 chunk values: hashes with chunk value k are order[start[k]:start[k] + size[k]]
+        order = np.argsort(chunk_keys, kind='stable')
+        bucket_sizes = np.bincount(chunk_keys, minlength=CHUNK_MASK + 1)
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        join_sizes = np.where(crowded[chunk], 0, bucket_sizes)
+        own_crowded = crowded[chunk][chunk_keys]
+
+        for flip_mask in flip_masks:
+            # Join every hash against the hashes whose chunk equals its own chunk with these bits flipped
+            queries = chunk_keys ^ flip_mask
+            matches = np.where(degrees[members] > DEGREE_LIMIT, 0, join_sizes[queries])
+            if not matches.any():
+                continue
+            left = bucket_starts[queries]
+            for start, stop in _blocks(matches):
+                block_matches = matches[start:stop]
+                total = int(block_matches.sum())
+                if total == 0:
+                    continue
+                rows = np.repeat(np.arange(start, stop), block_matches)
+                offsets = np.repeat(left[start:stop] - (np.cumsum(block_matches) - block_matches), block_matches)
+                cols = order[offsets + np.arange(total)]
+                # Each pair is found from both sides, except when the other side's own bucket is crowded
+                keep = (rows < cols) | (own_crowded[rows] & (rows != cols))
+                rows, cols = rows[keep], cols[keep]
+                close = hamming_distances(values[rows], values[cols]) <= threshold
+                rows, cols = members[rows[close]], members[cols[close]]
+                sparse = (degrees[rows] <= DEGREE_LIMIT) & (degrees[cols] <= DEGREE_LIMIT)
+                rows, cols = rows[sparse], cols[sparse]
+                np.add.at(degrees, rows, 1)
+                np.add.at(degrees, cols, 1)
+                yield rows, cols
+
+        rest = [other for other in chunks if other != chunk]
+        own_crowded = own_crowded & (degrees[members] <= DEGREE_LIMIT)
+        if rest and threshold // len(rest) <= MAX_RADIUS:
+            dense = own_crowded
+            if threshold // len(rest) == radius:
+                # At the same radius the remaining chunks were already searched above, so a missed pair
+                # must also be crowded on one of them
+                dense = dense & np.any([crowded[other][keys[other]] for other in rest], axis=0)
+            if np.count_nonzero(dense) > 1:
+                yield from _near_pairs(hashes, members[dense], rest, threshold, rank, degrees)
+        elif np.count_nonzero(own_crowded) > 1:
+            yield from _greedy_pairs(hashes, members[own_crowded], threshold, rank)
+
+
+def _greedy_pairs(hashes, members, threshold, rank, targets=None):
+    """Yield (representative, hash) pairs for hashes with too many close hashes to list every pair
+
+    Scans `members` in name order (`rank`): each one not yet taken becomes a representative and
+    takes every remaining hash of `targets` (default `members`) within `threshold` bits, so the
+    pairs stay linear in the number of hashes even when they are all close to each other.
+    """
+    targets = members if targets is None else targets
+    taken = np.zeros(len(hashes), dtype=np.bool_)
+    for representative in members[np.argsort(rank[members], kind='stable')].tolist():
+        if taken[representative]:
+            continue
+        taken[representative] = True
+        remaining = targets[~taken[targets]]
+        close = remaining[hamming_distances(hashes[remaining], hashes[representative]) <= threshold]
+        taken[close] = True
+        yield np.full(len(close), representative), close
+
+
+class ImageHashIndex:
+    """Persistent per-folder index of perceptual hashes, refreshed incrementally by mtime"""
+
+    def __init__(self, folder_path, max_workers=None):
+        self.folder_path = os.path.abspath(folder_path)
+        self.index_path = cache_path(self.folder_path, INDEX_FILE_NAME)
+        self.max_workers = max_workers
+        data = load_cache(self.index_path, INDEX_VERSION)
+        self.entries = data.get('entries', {}) if data else {}
+        self.lock = threading.Lock()
+
+    def refresh(self, job=None):
+        """Hash new or modified images in a process pool and drop deleted ones"""
+        with self.lock:
+            changed, present = scan_folder(self.folder_path, IMAGE_EXTENSIONS,
+                                           lambda name, stat: stat_matches(self.entries.get(name), stat))
+            stale = dict(changed)
+
+            removed = [name for name in self.entries if name not in present]
+            for name in removed:
+                del self.entries[name]
+
+            if job:
+                job.set_total(len(stale))
+
+            try:
+                if stale:
+                    with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                        futures = {
+                            executor.submit(_hash_worker, os.path.join(self.folder_path, name)): name
+                            for name in stale
+                        }
+                        for future in as_completed(futures):
+                            if job and job.cancel_requested:
+                                executor.shutdown(wait=False, cancel_futures=True)
+                                job.check_cancelled()
+                            name = futures[future]
+                            hashes, error = future.result()
+                            entry = {'mtime': stale[name].st_mtime, 'size': stale[name].st_size}
+                            if error:
+                                logger.warning(f"Error hashing image {name}: {error}")
+                                entry['error'] = error
+                                if job:
+                                    job.add_error(f"Error hashing {name}: {error}")
+                            else:
+                                entry['dhash'] = format(hashes[0], '016x')
+                                entry['phash'] = format(hashes[1], '016x')
+                            self.entries[name] = entry
+                            if job:
+                                job.advance()
+            finally:
+                # Keep whatever was hashed, even if the run was cancelled
+                if stale or removed:
+                    save_cache(self.index_path, INDEX_VERSION, {'entries': self.entries})
+
+            if stale or removed:
+                logger.info(f"Image hash index refreshed: {len(stale)} updated, {len(removed)} removed in {self.folder_path}")
+            return len(stale)
+
+    def find_duplicate_clusters(self, hash_type='dhash', threshold=DEFAULT_THRESHOLD):
+        """Group images whose hashes are within `threshold` bits of each other
+
+        Uses multi-index hashing: the 64-bit hash is split into four 16-bit chunks, and by the
+        pigeonhole principle two hashes within `threshold` bits have at least one chunk within
+        threshold // 4 bits. For every chunk and every bit-flip pattern of that radius, candidate
+        pairs are found by a bucket-table join on chunk values, then verified with a vectorized popcount,
+        so the search never compares all pairs (see _near_pairs for crowded chunk values).
+
+        Clusters are formed greedily in name order: the first unassigned image becomes a representative
+        and takes every unassigned image within `threshold` bits of it. Unlike connected components,
+        gradually changing frames don't chain into one cluster, so every member is a near-duplicate of
+        its representative, which is the first name of the cluster.
+        """
+        if hash_type not in HASH_TYPES:
+            raise ValueError(f"Unknown hash type: {hash_type}")
+        threshold = max(0, min(int(threshold), MAX_THRESHOLD))
+
+        with self.lock:
+            names = sorted(name for name, entry in self.entries.items() if hash_type in entry)
+            hashes = np.array([int(self.entries[name][hash_type], 16) for name in names], dtype=np.uint64)
+
+        # Identical hashes are duplicates by definition; only distinct values go through the search
+        unique_hashes, first_index, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        count = len(unique_hashes)
+
+        edge_rows = []
+        edge_cols = []
+        degrees = np.zeros(count, dtype=np.int64)
+        chunks = list(range(CHUNK_COUNT))
+        for rows, cols in _near_pairs(unique_hashes, np.arange(count), chunks, threshold, first_index, degrees):
+            edge_rows.append(rows)
+            edge_cols.append(cols)
+        # The pairs of hashes over the limit are listed per representative instead
+        dense = np.flatnonzero(degrees > DEGREE_LIMIT)
+        if len(dense):
+            for rows, cols in _greedy_pairs(unique_hashes, dense, threshold, first_index, np.arange(count)):
+                edge_rows.append(rows)
+                edge_cols.append(cols)
+
+        # Greedy assignment to representatives; names are sorted, so first_index gives name order
+        labels = np.arange(count)
+        if edge_rows:
+            rows = np.concatenate(edge_rows)
+            cols = np.concatenate(edge_cols)
+            # Adjacency lists (both directions) as one array sliced by offsets
+            sources = np.concatenate((rows, cols))
+            order = np.argsort(sources, kind='stable')
+            neighbours = np.concatenate((cols, rows))[order]
+            offsets = np.searchsorted(sources[order], np.arange(count + 1))
+            assigned = np.zeros(count, dtype=np.bool_)
+            connected = np.flatnonzero(offsets[1:] > offsets[:-1])
+            for node in connected[np.argsort(first_index[connected])].tolist():
+                if assigned[node]:
+                    continue
+                assigned[node] = True
+                members = neighbours[offsets[node]:offsets[node + 1]]
+                members = members[~assigned[members]]
+                labels[members] = node
+                assigned[members] = True
+
+        clusters = {}
+        for name, label in zip(names, labels[inverse].tolist()):
+            clusters.setdefault(label, []).append(name)
+        return sorted((members for members in clusters.values() if len(members) > 1), key=lambda members: members[0])
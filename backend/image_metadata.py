@@ -0,0 +1,154 @@
+import os
+import math
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from folder_cache import IMAGE_EXTENSIONS, cache_path, load_cache, save_cache, stat_matches, scan_folder
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'image_metadata.json'
+INDEX_VERSION = 1
+
+# EXIF tag ids
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+# Formats whose getexif() only reads the header; PNG's can decode the whole image to find a trailing eXIf chunk
+HEADER_EXIF_FORMATS = {'JPEG', 'MPO', 'TIFF', 'WEBP'}
+
+
+def _gps_to_degrees(value, ref):
+    """Convert an EXIF (degrees, minutes, seconds) tuple to signed decimal degrees"""
+    try:
+        degrees, minutes, seconds = (float(part) for part in value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    decimal = degrees + minutes / 60.0 + seconds / 3600.0
+    # Pillow turns a 0/0 rational (common when the camera has no GPS fix) into nan
+    if not math.isfinite(decimal):
+        return None
+    if ref in ('S', 'W'):
+        decimal = -decimal
+    return round(decimal, 7)
+
+
+def _header_exif(img):
+    """Return the EXIF of an opened image without loading pixel data (None if there is none in the header)"""
+    if img.format in HEADER_EXIF_FORMATS:
+        return img.getexif()
+    raw = img.info.get('exif')
+    if not raw:
+        return None
+    exif = Image.Exif()
+    exif.load(raw)
+    return exif
+
+
+def read_image_metadata(image_path):
+    """Read image dimensions and EXIF fields from the file header without decoding pixels"""
+    # Image.open is lazy: it only parses the header, and _header_exif avoids getexif() calls that would load pixels
+    with Image.open(image_path) as img:
+        metadata = {
+            'width': img.width,
+            'height': img.height,
+            'mode': img.mode,
+            'format': img.format,
+            'timestamp': None,
+            'gps': None,
+            'orientation': None
+        }
+
+        exif = _header_exif(img)
+        if not exif:
+            return metadata
+
+        orientation = exif.get(TAG_ORIENTATION)
+        if orientation is not None:
+            metadata['orientation'] = int(orientation)
+
+        timestamp = exif.get_ifd(TAG_EXIF_IFD).get(TAG_DATETIME_ORIGINAL) or exif.get(TAG_DATETIME)
+        if timestamp:
+            metadata['timestamp'] = str(timestamp).strip('\x00 ')
+
+        gps = exif.get_ifd(TAG_GPS_IFD)
+        if GPS_LATITUDE in gps and GPS_LONGITUDE in gps:
+            lat = _gps_to_degrees(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF))
+            lng = _gps_to_degrees(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF))
+            if lat is not None and lng is not None:
+                metadata['gps'] = {'lat': lat, 'lng': lng}
+
+        return metadata
+
+
+class ImageMetadataIndex:
+    """Persistent per-folder index of image header metadata, refreshed incrementally by mtime"""
+
+    def __init__(self, folder_path, max_workers=8):
+        self.folder_path = str(folder_path)
+        self.index_path = cache_path(folder_path, INDEX_FILE_NAME)
+        self.max_workers = max_workers
+        data = load_cache(self.index_path, INDEX_VERSION)
+        self.entries = data.get('entries', {}) if data else {}
+        self.lock = threading.Lock()
+
+    def _read_entry(self, name, stat):
+        """Build a single index entry, recording errors instead of raising"""
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        try:
+            entry.update(read_image_metadata(os.path.join(self.folder_path, name)))
+        except Exception as e:
+            logger.warning(f"Error reading image header {name}: {e}")
+            entry['error'] = str(e)
+        return name, entry
+
+    def refresh(self):
+        """Re-read headers of new or modified images and drop deleted ones"""
+        with self.lock:
+            return self._refresh()
+
+    def _refresh(self):
+        stale, present = scan_folder(self.folder_path, IMAGE_EXTENSIONS,
+                                     lambda name, stat: stat_matches(self.entries.get(name), stat))
+        removed = [name for name in self.entries if name not in present]
+        if not stale and not removed:
+            return 0
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for name, entry in executor.map(lambda args: self._read_entry(*args), stale):
+                    self.entries[name] = entry
+        for name in removed:
+            del self.entries[name]
+
+        save_cache(self.index_path, INDEX_VERSION, {'entries': self.entries})
+
+        logger.info(f"Image metadata index refreshed: {len(stale)} updated, {len(removed)} removed in {self.folder_path}")
+        return len(stale)
+
+    def lookup(self, filenames):
+        """Return metadata for the given image names (None for unknown images)"""
+        with self.lock:
+            return {name: self._public_entry(self.entries.get(name)) for name in filenames}
+
+    def all(self):
+        """Return metadata for every indexed image"""
+        with self.lock:
+            return {name: self._public_entry(entry) for name, entry in self.entries.items()}
+
+    @staticmethod
+    def _public_entry(entry):
+        """Strip bookkeeping fields from an index entry"""
+        if entry is None:
+            return None
+        return {key: value for key, value in entry.items() if key not in ('mtime', 'size')}
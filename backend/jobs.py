@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_DIR = Path.home() / '.smartqc' / 'jobs'
+MAX_PERSISTED_JOBS = 200
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+FINISHED_STATES = {JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED}
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when cancellation was requested"""
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are already waiting for a worker"""
+
+
+class Job:
+    """Progress, cancellation flag and result of one long-running operation
+
+    A Job can also be created on its own (without a JobManager) so the same code path
+    reports progress whether it runs inline in a request or in the background.
+    """
+
+    def __init__(self, kind, description=''):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.description = description
+        self.status = JOB_QUEUED
+        self.total = 0
+        self.done = 0
+        self.errors = []
+        self.result = None
+        self.result_persisted = False
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+        self.changed = threading.Condition()
+        self.version = 0
+
+    def _notify(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def set_total(self, total):
+        """Set the number of work items (files) this job will process"""
+        self.total = total
+        self._notify()
+
+    def advance(self, count=1):
+        """Mark work items as done"""
+        self.done += count
+        self._notify()
+
+    def add_error(self, message):
+        """Record a non-fatal error (the job keeps going)"""
+        self.errors.append(message)
+        self._notify()
+
+    def check_cancelled(self):
+        """Call between work items; raises JobCancelled once cancellation was requested"""
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def wait_for_change(self, version, timeout):
+        """Block until the job changes after the given version, or the timeout expires"""
+        with self.changed:
+            if self.version == version:
+                self.changed.wait(timeout)
+            return self.version
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'description': self.description,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'error_count': len(self.errors),
+            'errors': self.errors[-100:],
+            'error': self.error,
+            'result': self.result,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'cancel_requested': self.cancel_requested
+        }
+
+
+class JobManager:
+    """Bounded worker pool running Jobs in the background; finished jobs are persisted as JSON"""
+
+    def __init__(self, jobs_dir=DEFAULT_JOBS_DIR, max_workers=2, max_pending=50):
+        self.jobs_dir = Path(jobs_dir)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='smartqc-job')
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind, func, description=''):
+        """Queue func(job) to run in the worker pool and return the Job"""
+        with self.lock:
+            pending = sum(1 for job in self.jobs.values() if job.status == JOB_QUEUED)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs are already queued")
+            job = Job(kind, description)
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, func)
+        logger.info(f"Queued job {job.id} ({kind})")
+        return job
+
+    def _run(self, job, func):
+        if job.cancel_requested:
+            job.status = JOB_CANCELLED
+        else:
+            job.status = JOB_RUNNING
+            job.started = time.time()
+            job._notify()
+            try:
+                job.result = func(job)
+                job.status = JOB_COMPLETED
+            except JobCancelled:
+                job.status = JOB_CANCELLED
+                logger.info(f"Job {job.id} ({job.kind}) cancelled after {job.done}/{job.total} items")
+            except Exception as e:
+                job.status = JOB_FAILED
+                job.error = str(e)
+                logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+
+        job.finished = time.time()
+        self._persist(job)
+        job._notify()
+
+    def _persist(self, job):
+        """Write a finished job to disk, then release its result from memory (get_dict reads it back)
+
+        Also drops the oldest persisted jobs over the limit.
+        """
+        try:
+            self.jobs_dir.mkdir(parents=True, exist_ok=True)
+            job_path = self.jobs_dir / f"{job.id}.json"
+            tmp_path = job_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, job_path)
+            # Results such as export reports can hold every object of a folder. Flag the job first,
+            # so get_dict reads the file rather than a finished job without its result
+            job.result_persisted = True
+            job.result = None
+
+            job_paths = sorted(self.jobs_dir.glob('*.json'), key=lambda path: path.stat().st_mtime)
+            for old_path in job_paths[:-MAX_PERSISTED_JOBS]:
+                old_path.unlink()
+        except Exception as e:
+            logger.warning(f"Failed to persist job {job.id}: {e}")
+
+        with self.lock:
+            finished = [j for j in self.jobs.values() if j.status in FINISHED_STATES]
+            for old_job in sorted(finished, key=lambda j: j.finished)[:-MAX_PERSISTED_JOBS]:
+                del self.jobs[old_job.id]
+
+    def get(self, job_id):
+        """Return a live Job, or None (see get_dict for persisted jobs)"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_dict(self, job_id):
+        """Return the state of a job, reading finished jobs (and their results) from disk"""
+        job = self.get(job_id)
+        if job is not None:
+            job_data = job.to_dict()
+            # Checked after copying: _persist sets the flag before releasing the result, so if it is
+            # still unset the copy holds the result
+            if not job.result_persisted:
+                return job_data
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        job_path = self.jobs_dir / f"{job_id}.json"
+        if not job_path.exists():
+            return job.to_dict() if job is not None else None
+        with open(job_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def list_jobs(self):
+        """List jobs known to this process, newest first, without their results"""
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda j: j.created, reverse=True)
+        summaries = []
+        for job in jobs:
+            summary = job.to_dict()
+            del summary['result']
+            del summary['errors']
+            summaries.append(summary)
+        return summaries
+
+    def cancel(self, job_id):
+        """Request cooperative cancellation; returns the Job, or None if unknown"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.status not in FINISHED_STATES:
+            job.cancel_requested = True
+            job._notify()
+        return job
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import re
+import hashlib
+import threading
+import logging
+
+from folder_cache import cache_path
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR_NAME = 'snapshots'
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Pruning goes down to this fraction of the budget, so the next saves don't immediately prune again
+PRUNE_LOW_WATER = 0.8
+OPERATION_ID_PATTERN = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+
+
+class SnapshotOperation:
+    """Handle for one operation; records the pre-operation version of each file it touches"""
+
+    def __init__(self, store, operation_id, kind, description=''):
+        self.store = store
+        self.id = operation_id
+        self.kind = kind
+        self.description = description
+        self.created = time.time()
+        self.files = {}
+        self.journal = None
+
+    def record(self, file_path):
+        """Snapshot a file before it is overwritten (only the first call per file counts)"""
+        name = os.path.relpath(file_path, self.store.folder_path)
+        if name in self.files:
+            return
+        digest = self.store.put_file(file_path)
+        self.files[name] = digest
+        self._append_journal({'name': name, 'digest': digest})
+
+    def _append_journal(self, record):
+        """Append to the operation's journal, so a run interrupted by a crash can still be rolled back"""
+        if self.journal is None:
+            self.store.operations_dir.mkdir(parents=True, exist_ok=True)
+            self.journal = open(self.store._journal_path(self.id), 'a', encoding='utf-8')
+            header = {key: value for key, value in self.to_dict().items() if key != 'files'}
+            self.journal.write(json.dumps(header) + '\n')
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'description': self.description,
+            'created': self.created,
+            'files': self.files
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Save the manifest even if the operation failed half way, so the partial run can be rolled back
+        self.store.finish_operation(self)
+        return False
+
+
+class SnapshotStore:
+    """Content-addressed, compressed store of annotation file versions grouped by operation id"""
+
+    def __init__(self, folder_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder_path = os.path.abspath(folder_path)
+        self.root = cache_path(self.folder_path, SNAPSHOT_DIR_NAME)
+        self.objects_dir = self.root / 'objects'
+        self.operations_dir = self.root / 'operations'
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Scanned from disk on first use, then kept up to date: digests referenced by each
+        # persisted operation, reference counts (persisted and in-progress operations) and object sizes
+        self.references = None
+        self.refcounts = None
+        self.object_sizes = None
+        self.usage = None
+
+    def _object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest[2:]
+
+    def _operation_path(self, operation_id):
+        return self.operations_dir / f"{operation_id}.json"
+
+    def _journal_path(self, operation_id):
+        return self.operations_dir / f"{operation_id}.journal"
+
+    def _recover_journal(self, journal_path):
+        """Turn the journal of an operation interrupted by a crash into a manifest marked interrupted"""
+        operation_path = journal_path.with_suffix('.json')
+        if not operation_path.exists():
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            operation = None
+            files = {}
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut off by the crash
+                    break
+                if operation is None:
+                    operation = record
+                else:
+                    files[record['name']] = record['digest']
+            if operation is None or not files:
+                journal_path.unlink()
+                return
+            operation.update({'files': files, 'interrupted': True})
+            tmp_path = operation_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(operation, f)
+            os.replace(tmp_path, operation_path)
+            logger.warning(f"Recovered interrupted snapshot operation {operation['id']} with {len(files)} files")
+        journal_path.unlink()
+
+    def _load_state(self):
+        """Scan manifests and objects once (call with the lock held)"""
+        if self.references is not None:
+            return
+        references = {}
+        if self.operations_dir.exists():
+            # Journals left on disk belong to operations of a process that died: nothing in this
+            # process can have journaled yet, since put_file loads the state before the first record
+            for journal_path in self.operations_dir.glob('*.journal'):
+                try:
+                    self._recover_journal(journal_path)
+                except Exception as e:
+                    logger.warning(f"Failed to recover snapshot journal {journal_path}: {e}")
+            for operation_path in self.operations_dir.glob('*.json'):
+                try:
+                    with open(operation_path, 'r', encoding='utf-8') as f:
+                        references[operation_path.stem] = [d for d in json.load(f).get('files', {}).values() if d]
+                except Exception as e:
+                    logger.warning(f"Skipping unreadable snapshot manifest {operation_path}: {e}")
+
+        object_sizes = {}
+        if self.objects_dir.exists():
+            for object_path in self.objects_dir.glob('*/*'):
+                if object_path.is_file() and not object_path.name.endswith('.tmp'):
+                    object_sizes[object_path.parent.name + object_path.name] = object_path.stat().st_size
+
+        self.refcounts = {}
+        for digests in references.values():
+            for digest in digests:
+                self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+        self.references = references
+        self.object_sizes = object_sizes
+        self.usage = sum(object_sizes.values())
+
+    def _release(self, digest):
+        """Drop one reference to an object, deleting it once nothing references it (call with the lock held)"""
+        count = self.refcounts.get(digest, 0) - 1
+        if count > 0:
+            self.refcounts[digest] = count
+            return
+        self.refcounts.pop(digest, None)
+        self._remove_object(digest)
+
+    def _remove_object(self, digest):
+        try:
+            self._object_path(digest).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove snapshot object {digest}: {e}")
+            return
+        self.usage -= self.object_sizes.pop(digest, 0)
+
+    def put_file(self, file_path):
+        """Store the current content of a file and return its digest (None if the file doesn't exist)
+
+        The returned digest holds a reference that protects the object from pruning; it is
+        handed over to the operation manifest by finish_operation.
+        """
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        # Take the reference before writing, so a concurrent prune can't delete the object in between
+        with self.lock:
+            self._load_state()
+            self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+            stored = digest in self.object_sizes
+
+        if not stored:
+            object_path = self._object_path(digest)
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = object_path.with_name(f"{object_path.name}.{uuid.uuid4().hex}.tmp")
+            compressed = zlib.compress(content, 6)
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, object_path)
+            with self.lock:
+                if digest not in self.object_sizes:
+                    self.object_sizes[digest] = len(compressed)
+                    self.usage += len(compressed)
+        return digest
+
+    def read_object(self, digest):
+        """Return the decompressed content stored under a digest"""
+        with open(self._object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def begin_operation(self, kind, description=''):
+        """Start a new operation; use as a context manager or call finish_operation when done"""
+        operation_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        return SnapshotOperation(self, operation_id, kind, description)
+
+    def finish_operation(self, operation):
+        """Persist the operation manifest (replacing its journal) and prune older operations over the disk budget"""
+        operation.close_journal()
+        if not operation.files:
+            return
+        digests = [d for d in operation.files.values() if d]
+        with self.lock:
+            # If this fails the journal stays, and its references are recovered on the next start
+            self.operations_dir.mkdir(parents=True, exist_ok=True)
+            operation_path = self._operation_path(operation.id)
+            tmp_path = operation_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(operation.to_dict(), f)
+            os.replace(tmp_path, operation_path)
+            self._journal_path(operation.id).unlink(missing_ok=True)
+            self.references[operation.id] = digests
+            operation_bytes = sum(self.object_sizes.get(digest, 0) for digest in set(digests))
+        logger.info(f"Recorded snapshot operation {operation.id} ({operation.kind}) with {len(operation.files)} files")
+
+        if operation_bytes > self.max_bytes:
+            logger.warning(f"Snapshot operation {operation.id} alone takes {operation_bytes} bytes, "
+                           f"over the {self.max_bytes} byte budget; keeping it so it can be rolled back")
+        self.prune(keep=operation.id)
+
+    def get_operation(self, operation_id):
+        """Load an operation manifest, or None if it doesn't exist"""
+        if not OPERATION_ID_PATTERN.match(operation_id or ''):
+            return None
+        with self.lock:
+            # Recovers journals of interrupted operations on first use
+            self._load_state()
+        operation_path = self._operation_path(operation_id)
+        if not operation_path.exists():
+            return None
+        with open(operation_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def list_operations(self):
+        """List operations, newest first, without their file maps"""
+        with self.lock:
+            self._load_state()
+        operations = []
+        if not self.operations_dir.exists():
+            return operations
+        for operation_path in sorted(self.operations_dir.glob('*.json'), reverse=True):
+            try:
+                with open(operation_path, 'r', encoding='utf-8') as f:
+                    operation = json.load(f)
+                operations.append({
+                    'id': operation['id'],
+                    'kind': operation.get('kind'),
+                    'description': operation.get('description', ''),
+                    'created': operation.get('created'),
+                    'file_count': len(operation.get('files', {})),
+                    'interrupted': operation.get('interrupted', False)
+                })
+            except Exception as e:
+                logger.warning(f"Skipping unreadable snapshot manifest {operation_path}: {e}")
+        return operations
+
+    def _restore(self, name, digest, rollback_operation):
+        """Restore one file to a recorded version (None means the file didn't exist)"""
+        file_path = os.path.join(self.folder_path, name)
+        rollback_operation.record(file_path)
+        if digest is None:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return
+        content = self.read_object(digest)
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+
+    def rollback(self, operation_id, filename=None):
+        """Restore all files (or a single file) touched by an operation to their pre-operation state
+
+        The rollback itself is recorded as an operation, so it can be undone the same way.
+        Returns (files_restored, errors, rollback_operation_id), or None if the operation
+        (or the file within it) is unknown.
+        """
+        operation = self.get_operation(operation_id)
+        if operation is None:
+            return None
+
+        files = operation.get('files', {})
+        if filename is not None:
+            if filename not in files:
+                return None
+            files = {filename: files[filename]}
+
+        files_restored = 0
+        errors = []
+        with self.begin_operation('rollback', f"Rollback of {operation_id}") as rollback_operation:
+            for name, digest in files.items():
+                try:
+                    self._restore(name, digest, rollback_operation)
+                    files_restored += 1
+                except Exception as e:
+                    error_msg = f"Error restoring {name}: {str(e)}"
+                    errors.append(error_msg)
+                    logger.error(error_msg)
+
+        logger.info(f"Rolled back {files_restored} files from snapshot operation {operation_id}")
+        return files_restored, errors, rollback_operation.id
+
+    def disk_usage(self):
+        """Total size in bytes of stored objects (scanned once, then tracked as objects are added and removed)"""
+        with self.lock:
+            self._load_state()
+            return self.usage
+
+    def prune(self, max_bytes=None, keep=None):
+        """Once stored objects exceed the budget, drop the oldest operations down to PRUNE_LOW_WATER of it
+
+        Operations still in progress are never pruned (they have no manifest yet), nor is `keep`.
+        Unreferenced objects are deleted as soon as their last operation is dropped.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self.lock:
+            self._load_state()
+            if self.usage <= max_bytes:
+                return 0
+            target = int(max_bytes * PRUNE_LOW_WATER)
+
+            # Objects left behind by an interrupted write
+            for digest in [d for d in self.object_sizes if d not in self.refcounts]:
+                self._remove_object(digest)
+
+            # Oldest first; operation ids start with a timestamp so name order is chronological
+            operations_removed = 0
+            for operation_id in sorted(self.references):
+                if self.usage <= target:
+                    break
+                if operation_id == keep:
+                    continue
+                try:
+                    self._operation_path(operation_id).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Failed to remove snapshot manifest {operation_id}: {e}")
+                    continue
+                for digest in self.references.pop(operation_id):
+                    self._release(digest)
+                operations_removed += 1
+            usage = self.usage
+
+        logger.info(f"Pruned {operations_removed} snapshot operations to {usage} bytes (budget {max_bytes})")
+        return operations_removed